@@ -24,27 +24,40 @@
 #
 
 import argparse
+import bisect
 import curses
 import datetime
 import errno
 import logging
+import logging.handlers
+import operator
 import os
 import re
 import subprocess
 import sys
+import threading
+import time
 from collections import deque
 from functools import reduce
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 SYSTAT_VERSION_OLD = 0
 SYSTAT_VERSION_NEW = 1
 
-log = []
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+log = deque(maxlen=1000)
+log_count = 0
+log_file = None
 script_pid = os.getpid()
 pid = 0
 debug_enabled = False
 trace_enabled = False
 systat_version = None
 kind_systat_version = SYSTAT_VERSION_NEW
+thread_group_pattern = re.compile(r"[-_#\s]*\d+$")
 
 
 def main():
@@ -53,25 +66,73 @@ def main():
     try:
         parser = create_parser()
         args = parser.parse_args()
+        setup_log(args.log_size, args.log_file)
+        if args.diff is not None:
+            if args.sort_field not in SessionDiff.SORT_FIELDS:
+                parser.error("--sort {} is not supported with --diff, expected one of: {}"
+                             .format(args.sort_field, ", ".join(SessionDiff.SORT_FIELDS)))
+            run_diff_view(args.diff[0], args.diff[1], args.diff_key, args.sort_field, args.number, args.debug_enabled)
+            return
+        if args.pid is None:
+            parser.error("the following arguments are required: -p")
         pid = args.pid
         if not check_pid(pid):
             sys.exit("PID {} not exist".format(pid))
+        if args.state_sampling_hz is not None and not 50 <= args.state_sampling_hz <= 200:
+            parser.error("--state-sampling must be between 50 and 200 Hz")
+        try:
+            alert_rules = [AlertRule.compile(rule) for rule in args.alert_rules]
+        except ValueError as exc:
+            parser.error(str(exc))
+        if len(alert_rules) > 0:
+            try:
+                os.makedirs(args.snapshot_dir, exist_ok=True)
+            except OSError as exc:
+                parser.error("--snapshot-dir {} can't be created: {}".format(args.snapshot_dir, exc))
+            if not os.access(args.snapshot_dir, os.W_OK | os.X_OK):
+                parser.error("--snapshot-dir {} is not writable".format(args.snapshot_dir))
         load_systat_version()
-        params = Params(args.stack_size, args.number, args.sort_field, args.jstack_enabled, args.debug_enabled)
+        params = Params(args.stack_size, args.number, args.sort_field, args.jstack_enabled, args.debug_enabled,
+                        args.metrics_port, args.metrics_top, args.metrics_grouped, args.state_sampling_hz,
+                        args.view, args.numa_enabled, alert_rules, args.snapshot_dir, args.alert_cooldown)
         java_handler = JavaHotSpotHandler(params.jstack_enabled)
         sort_description, stats_sorter = StatsSorter.by_field(params.field_sort)
+        metrics_exporter = None
+        if params.metrics_port is not None:
+            metrics_exporter = MetricsExporter(params.metrics_port, params.metrics_top, params.metrics_grouped,
+                                               stats_sorter)
+        thread_state_sampler = None
+        if params.state_sampling_hz is not None:
+            thread_state_sampler = ThreadStateSampler(params.state_sampling_hz)
+        cgroup_stats = CgroupStats.find()
+        if params.view == 'cpu':
+            sort_description = 'Per-CPU view' + (' by NUMA node' if params.numa_enabled else '')
         title = title_row(java_handler.is_instrumented_java, sort_description)
         debug_enabled = params.debug_enabled
         debug_log = "Debug is enabled" if debug_enabled else "Debug is disabled"
         systat_log = "Systat version {} (output with {} version)".format(systat_version,
                                                                          "New" if kind_systat_version == SYSTAT_VERSION_NEW else "Old")
         filename = os.path.basename(__file__)
-        log_info("Running {} with pid {}.\n{}\n{}".format(filename, os.getpid(), debug_log, systat_log))
-        log_debug("Sys info: {}".format(sys.version))
-        if args.display_type == 'refresh':
-            run_refresh_view(params, stats_sorter, java_handler, title)
-        else:
-            run_terminal_view(params, stats_sorter, java_handler, title)
+        log_info("Running {} with pid {}.\n{}\n{}", filename, os.getpid(), debug_log, systat_log)
+        log_debug("Sys info: {}", sys.version)
+        if metrics_exporter is not None:
+            metrics_exporter.start()
+        if thread_state_sampler is not None:
+            thread_state_sampler.start()
+        try:
+            if args.display_type == 'refresh':
+                run_refresh_view(params, stats_sorter, java_handler, metrics_exporter, thread_state_sampler,
+                                 cgroup_stats, title)
+            else:
+                run_terminal_view(params, stats_sorter, java_handler, metrics_exporter, thread_state_sampler,
+                                  cgroup_stats, title)
+        finally:
+            if thread_state_sampler is not None:
+                thread_state_sampler.stop()
+            if cgroup_stats is not None:
+                cgroup_stats.close()
+            if metrics_exporter is not None:
+                metrics_exporter.stop()
     except KeyboardInterrupt:
         pass
     except Exception as exp:
@@ -80,7 +141,9 @@ def main():
     finally:
         if len(log) > 0:
             print("\nExecution log:\n")
-        print("\n".join(log))
+        if log_count > len(log):
+            print("... {} older messages discarded".format(log_count - len(log)))
+        print("\n".join(format_log_entry(*entry) for entry in log))
 
 
 def load_systat_version():
@@ -97,9 +160,9 @@ def load_systat_version():
 
 def create_parser():
     parser = argparse.ArgumentParser(description='Tool for analysing active Threads')
-    parser.add_argument('-p', required=True,
+    parser.add_argument('-p',
                         type=int, dest='pid',
-                        help='Process ID')
+                        help='Process ID (required unless --diff is used)')
     parser.add_argument('-n', nargs='?', dest='number',
                         type=int, default=10,
                         help='Number of threads to show per sample. Default: 10')
@@ -107,7 +170,8 @@ def create_parser():
                         type=int, default=1, dest='stack_size',
                         help='Max number of stack frames (only when jstack can be used). Default: 1')
     parser.add_argument('--sort', '-s', nargs='?', dest='sort_field',
-                        choices=['cpu', 'rq', 'disk', 'disk-rd', 'disk-wr'], default='cpu',
+                        choices=['cpu', 'rq', 'disk', 'disk-rd', 'disk-wr', 'cs', 'cs-vol', 'cs-invol',
+                                 'migrations', 'throttled'], default='cpu',
                         help='Field used for sorting. Default: cpu')
     parser.add_argument('--display', '-d', nargs='?', dest='display_type',
                         choices=['terminal', 'refresh'], default='refresh',
@@ -118,6 +182,51 @@ def create_parser():
     parser.add_argument('--debug', dest='debug_enabled',
                         action="store_true",
                         help='Turn on logs for debugging purposes')
+    parser.add_argument('--metrics-port', dest='metrics_port',
+                        type=int, default=None,
+                        help='Serve the stats in OpenMetrics format on http://127.0.0.1:<port>/metrics')
+    parser.add_argument('--metrics-top', nargs='?', dest='metrics_top',
+                        type=int, default=20,
+                        help='Max number of threads (or groups) exported per sample. Default: 20')
+    parser.add_argument('--metrics-group', dest='metrics_grouped',
+                        action="store_true",
+                        help='Export stats aggregated by thread group (name without the trailing number)')
+    parser.add_argument('--state-sampling', nargs='?', dest='state_sampling_hz',
+                        type=int, const=100, default=None,
+                        help='Sample the state of each thread (R/S/D) in background at the given '
+                             'frequency (50-200 Hz). Default when enabled: 100')
+    parser.add_argument('--view', '-v', nargs='?', dest='view',
+                        choices=['threads', 'cpu'], default='threads',
+                        help='Select the stats to display: top threads or aggregated per CPU. Default: threads')
+    parser.add_argument('--numa', dest='numa_enabled',
+                        action="store_true",
+                        help='Aggregate the CPUs per NUMA node too (only with --view cpu)')
+    parser.add_argument('--alert', dest='alert_rules',
+                        action="append", default=[], metavar='RULE',
+                        help='Capture a snapshot of all the threads when a thread matches the rule, '
+                             'e.g. "total_cpu > 90 for 3 samples" or "delta_run_queue_latency > 1ms". '
+                             'It can be repeated')
+    parser.add_argument('--snapshot-dir', dest='snapshot_dir',
+                        default='.',
+                        help='Directory where the snapshots of the alerts are saved. Default: .')
+    parser.add_argument('--alert-cooldown', dest='alert_cooldown',
+                        type=int, default=60,
+                        help='Min number of seconds between two snapshots of the same alert. Default: 60')
+    parser.add_argument('--diff', nargs=2, dest='diff',
+                        metavar=('A', 'B'), default=None,
+                        help='Compare two logs saved from "pidstat -u -d -t -h" instead of watching a process. '
+                             'Each one is FILE or FILE:FIRST-LAST to take a range of iterations')
+    parser.add_argument('--diff-by', nargs='?', dest='diff_key',
+                        choices=['name', 'group'], default='name',
+                        help='Match the threads of both logs by name or by group (name without the trailing '
+                             'number). Default: name')
+    parser.add_argument('--log-size', dest='log_size',
+                        type=int, default=1000,
+                        help='Number of the most recent log messages printed at exit. Default: 1000')
+    parser.add_argument('--log-file', dest='log_file',
+                        default=None,
+                        help='Write the log to this file too, rotated every {} MB'
+                        .format(LOG_FILE_MAX_BYTES // (1024 * 1024)))
     return parser
 
 
@@ -128,27 +237,83 @@ def title_row(is_instrumented_java, sort_description):
         return "Generating thread stats for Process {} - {}".format(pid, sort_description)
 
 
-def run_terminal_view(params, stats_sorter, java_handler, title):
-    call_pidstat(StatsProcessor(params, StatsTerminalPrinter(title), stats_sorter, java_handler))
+def run_terminal_view(params, stats_sorter, java_handler, metrics_exporter, thread_state_sampler, cgroup_stats,
+                      title):
+    call_pidstat(StatsProcessor(params, StatsTerminalPrinter(title), stats_sorter, java_handler,
+                                metrics_exporter, thread_state_sampler, cgroup_stats))
 
 
-def run_refresh_view(params, stats_sorter, java_handler, title):
+def run_refresh_view(params, stats_sorter, java_handler, metrics_exporter, thread_state_sampler, cgroup_stats,
+                     title):
     with StatsRefreshPrinter(title) as printer:
-        call_pidstat(StatsProcessor(params, printer, stats_sorter, java_handler))
+        call_pidstat(StatsProcessor(params, printer, stats_sorter, java_handler,
+                                    metrics_exporter, thread_state_sampler, cgroup_stats))
 
 
-def log_info(msg):
-    log.append("{} | INFO | {}".format(datetime.datetime.now(), msg))
+def run_diff_view(source_a, source_b, key, field_sort, top_num, debug):
+    global debug_enabled
+    debug_enabled = debug
+    readers = [PidStatsLogReader(source_a), PidStatsLogReader(source_b)]
+    for reader in readers:
+        if not os.path.isfile(reader.path):
+            sys.exit("File {} not exist".format(reader.path))
+    session_a = SessionStats.load(readers[0], key)
+    session_b = SessionStats.load(readers[1], key)
+    session_diff = SessionDiff(session_a, session_b, field_sort)
+    StatsTerminalPrinter("Diff of {} vs {} - {}".format(source_a, source_b, session_diff.description)) \
+        .display_diff(session_diff.ranking(top_num))
+
+
+def setup_log(log_size, log_file_path):
+    """
+    Keep only the last `log_size` messages in memory and, optionally,
+    write them to a rotating file too.
+    """
+    global log
+    global log_file
+    log = deque(maxlen=max(log_size, 0))
+    if log_file_path is not None:
+        log_file = logging.getLogger("top_threads")
+        log_file.propagate = False
+        log_file.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(log_file_path, maxBytes=LOG_FILE_MAX_BYTES,
+                                                       backupCount=LOG_FILE_BACKUPS)
+        log_file.addHandler(handler)
 
 
-def log_debug(msg):
+def log_info(msg, *args):
+    append_log("INFO", msg, args)
+
+
+def log_debug(msg, *args):
     if debug_enabled:
-        log.append("{} | DEBUG | {}".format(datetime.datetime.now(), msg))
+        append_log("DEBUG", msg, args)
 
 
-def log_trace(msg):
+def log_trace(msg, *args):
     if trace_enabled:
-        log.append("{} | TRACE | {}".format(datetime.datetime.now(), msg))
+        append_log("TRACE", msg, args)
+
+
+def append_log(level, msg, args):
+    """
+    The message is formatted with its args only when it's emitted: when it's
+    written to the log file or printed at exit, if it's still in the buffer.
+    Exceptions are kept as text, otherwise their traceback would keep alive
+    the frames where they were raised while they are in the buffer.
+    """
+    global log_count
+    if any(isinstance(arg, BaseException) for arg in args):
+        args = tuple(str(arg) if isinstance(arg, BaseException) else arg for arg in args)
+    entry = (datetime.datetime.now(), level, msg, args)
+    log.append(entry)
+    log_count += 1
+    if log_file is not None:
+        log_file.info(format_log_entry(*entry))
+
+
+def format_log_entry(timestamp, level, msg, args):
+    return "{} | {} | {}".format(timestamp, level, msg.format(*args) if args else msg)
 
 
 def get_systat_version():
@@ -191,7 +356,7 @@ def call_pidstat(stats_processor):
     if kind_systat_version == SYSTAT_VERSION_NEW:
         fix_time_display.append("-H")
     args = ["pidstat", "-u", "-d", "-t", "-h"] + fix_time_display + ["-p", str(pid), "1"]
-    log_debug("pidstat command: {}".format(" ".join(args)))
+    log_debug("pidstat command: {}", " ".join(args))
     process = subprocess.Popen(args,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE,
@@ -213,17 +378,28 @@ def call_pidstat(stats_processor):
         for output in iter(lambda: process.stderr.readline(), b''):
             lines.append(output.decode().strip())
         if len(lines) > 0:
-            log_info("Error from pidstat: {}".format("".join(lines)))
+            log_info("Error from pidstat: {}", "".join(lines))
 
 
 class Params:
 
-    def __init__(self, max_stack_depth, top_num, field_sort, jstack_enabled, debug_enabled):
+    def __init__(self, max_stack_depth, top_num, field_sort, jstack_enabled, debug_enabled,
+                 metrics_port=None, metrics_top=20, metrics_grouped=False, state_sampling_hz=None,
+                 view='threads', numa_enabled=False, alert_rules=None, snapshot_dir='.', alert_cooldown=60):
         self.max_stack_depth = max_stack_depth
         self.top_num = top_num
         self.field_sort = field_sort
         self.jstack_enabled = jstack_enabled
         self.debug_enabled = debug_enabled
+        self.metrics_port = metrics_port
+        self.metrics_top = metrics_top
+        self.metrics_grouped = metrics_grouped
+        self.state_sampling_hz = state_sampling_hz
+        self.view = view
+        self.numa_enabled = numa_enabled
+        self.alert_rules = alert_rules if alert_rules is not None else []
+        self.snapshot_dir = snapshot_dir
+        self.alert_cooldown = alert_cooldown
 
 
 class StatsSorter:
@@ -245,6 +421,22 @@ class StatsSorter:
         elif field == "disk-wr":
             msg = 'Sorting by Disk (write/sec)'
             return msg, lambda x: x.thread_stats.disk.kb_wr_per_sec
+        elif field == "cs":
+            msg = 'Sorting by context switches (voluntary + involuntary)'
+            return msg, lambda x: (x.thread_stats.switches.delta_voluntary_switches +
+                                   x.thread_stats.switches.delta_involuntary_switches)
+        elif field == "cs-vol":
+            msg = 'Sorting by voluntary context switches'
+            return msg, lambda x: x.thread_stats.switches.delta_voluntary_switches
+        elif field == "cs-invol":
+            msg = 'Sorting by involuntary context switches'
+            return msg, lambda x: x.thread_stats.switches.delta_involuntary_switches
+        elif field == "migrations":
+            msg = 'Sorting by CPU migrations'
+            return msg, lambda x: x.thread_stats.switches.delta_migrations
+        elif field == "throttled":
+            msg = 'Sorting by estimated time throttled by the cgroup'
+            return msg, lambda x: x.thread_stats.scheduler_stats.delta_throttled_time
         else:
             msg = 'Sorting by default (CPU)'
             return msg, lambda x: x.thread_stats.cpu.total_cpu
@@ -264,14 +456,19 @@ class ThreadInfo:
     def update_dump(self, dump):
         self.dump = dump
 
+    def group_name(self):
+        return thread_group_pattern.sub("", self.name) or self.name
+
 
 class ThreadStats:
 
-    def __init__(self, tid, cpu=None, disk=None, scheduler_stats=None):
+    def __init__(self, tid, cpu=None, disk=None, scheduler_stats=None, state=None, switches=None):
         self.tid = tid
         self.cpu = cpu if cpu is not None else ThreadCPUStats(tid)
         self.disk = disk if disk is not None else ThreadDiskStats(tid)
         self.scheduler_stats = scheduler_stats if scheduler_stats is not None else SchedulerStats(tid)
+        self.state = state if state is not None else ThreadStateStats(tid)
+        self.switches = switches if switches is not None else ThreadSwitchStats(tid)
 
 
 class ThreadCPUStats:
@@ -294,6 +491,70 @@ class ThreadDiskStats:
         self.kb_wr_per_sec = kb_wr_per_sec
 
 
+class ThreadSwitchStats:
+
+    def __init__(self, tid):
+        self.__tid = tid
+
+        self.__voluntary_switches = None
+        self.__involuntary_switches = None
+        self.__migrations = None
+        self.__last_cpu = None
+
+        self.delta_voluntary_switches = 0
+        self.delta_involuntary_switches = 0
+        self.delta_migrations = 0
+
+    def update(self, voluntary, involuntary, migrations, cpu):
+        """
+        Update the deltas from the accumulated counters of the thread.
+        When the migrations are not provided by the kernel they are estimated
+        counting the changes of the last CPU reported by pidstat.
+        The deltas stay at 0 on the first sample of the thread.
+        """
+        if migrations is None:
+            migrations = self.__migrations if self.__migrations is not None else 0
+            if self.__last_cpu is not None and cpu != self.__last_cpu:
+                migrations += 1
+
+        if self.__voluntary_switches is not None:
+            self.delta_voluntary_switches = voluntary - self.__voluntary_switches
+            self.delta_involuntary_switches = involuntary - self.__involuntary_switches
+            self.delta_migrations = migrations - self.__migrations
+
+        self.__voluntary_switches = voluntary
+        self.__involuntary_switches = involuntary
+        self.__migrations = migrations
+        self.__last_cpu = cpu
+
+
+class ThreadStateStats:
+
+    def __init__(self, tid):
+        self.tid = tid
+        self.samples = 0
+        self.running = 0.0
+        self.sleeping = 0.0
+        self.disk_sleep = 0.0
+        self.other = 0.0
+        self.wchan = None
+
+    def update(self, counters, wchan):
+        """
+        Update the percentage of time in each state from the counters of
+        `ThreadStateSampler` ([R, S, D, other, samples]).
+        """
+        self.samples = samples = counters[ThreadStateSampler.SAMPLES]
+        if samples > 0:
+            self.running = 100.0 * counters[ThreadStateSampler.RUNNING] / samples
+            self.sleeping = 100.0 * counters[ThreadStateSampler.SLEEPING] / samples
+            self.disk_sleep = 100.0 * counters[ThreadStateSampler.DISK_SLEEP] / samples
+            self.other = 100.0 * counters[ThreadStateSampler.OTHER] / samples
+        else:
+            self.running = self.sleeping = self.disk_sleep = self.other = 0.0
+        self.wchan = wchan
+
+
 class SchedulerStats:
 
     def __init__(self, tid):
@@ -306,13 +567,14 @@ class SchedulerStats:
         self.delta_spent_on_cpu = 0
         self.delta_run_queue_latency = 0
         self.delta_timeslices_on_current_cpu = 0
+        # share of the time the cgroup was throttled, estimated by `CgroupStats`
+        self.delta_throttled_time = 0
 
     def update(self, on_cpu, on_runqueue, timeslices):
-        log_trace("TID: {}, on_runqueue {} -> {} (received: {})"
-                  .format(self.__tid,
-                          StatsRefreshPrinter.nanos_fmt(self.__run_queue_latency),
-                          StatsRefreshPrinter.nanos_fmt(on_runqueue - self.__run_queue_latency),
-                          StatsRefreshPrinter.nanos_fmt(on_runqueue)))
+        if trace_enabled:
+            log_trace("TID: {}, on_runqueue {} -> {} (received: {})", self.__tid,
+                      NanosFmt(self.__run_queue_latency), NanosFmt(on_runqueue - self.__run_queue_latency),
+                      NanosFmt(on_runqueue))
 
         new_delta_timeslices = timeslices - self.__timeslices_on_current_cpu
 
@@ -329,11 +591,20 @@ class SchedulerStats:
         self.__run_queue_latency = on_runqueue
         self.__timeslices_on_current_cpu = timeslices
 
+    @property
+    def spent_on_cpu(self):
+        return self.__spent_on_cpu
+
+    @property
+    def run_queue_latency(self):
+        return self.__run_queue_latency
+
 
 class PidStatsParser:
 
     @staticmethod
     def extract(lines):
+        """Update the stats of the threads in the output of pidstat and return their ids."""
         if kind_systat_version == SYSTAT_VERSION_NEW:
             return PidStatsParser.extract_with_new_version(lines)
         else:
@@ -341,13 +612,14 @@ class PidStatsParser:
 
     @staticmethod
     def extract_with_new_version(lines):
-        stats_by_tid = {}
+        thread_ids = set()
         for line in lines:
             values = re.split("(\s+)", line)
             # for debugging:
             # log_debug("Parsed values: " + "|".join(values))
             if len(values) >= 29 and values[6].isdigit():
                 thread_id = int(values[6])
+                thread_ids.add(thread_id)
                 StatsProcessor.get_thread(thread_id).thread_stats.cpu.cpu = values[18].rjust(2)
                 StatsProcessor.get_thread(thread_id).thread_stats.cpu.user_cpu = float(values[8])
                 StatsProcessor.get_thread(thread_id).thread_stats.cpu.system_cpu = float(values[10])
@@ -357,17 +629,18 @@ class PidStatsParser:
                 StatsProcessor.get_thread(thread_id).thread_stats.disk.kb_rd_per_sec = float(values[20])
                 StatsProcessor.get_thread(thread_id).thread_stats.disk.kb_wr_per_sec = float(values[22])
                 StatsProcessor.get_thread(thread_id).update_name(str(values[28]))
-        return stats_by_tid
+        return thread_ids
 
     @staticmethod
     def extract_with_old_version(lines):
-        stats_by_tid = {}
+        thread_ids = set()
         for line in lines:
             values = re.split("(\s+)", line)
             # for debugging:
             # log_debug("Parsed values: " + "|".join(values))
             if len(values) >= 27 and values[6].isdigit() and int(values[6]) != 0:
                 thread_id = int(values[6])
+                thread_ids.add(thread_id)
                 StatsProcessor.get_thread(thread_id).thread_stats.cpu.cpu = values[18].rjust(2)
                 StatsProcessor.get_thread(thread_id).thread_stats.cpu.user_cpu = float(values[8])
                 StatsProcessor.get_thread(thread_id).thread_stats.cpu.system_cpu = float(values[10])
@@ -377,18 +650,31 @@ class PidStatsParser:
                 StatsProcessor.get_thread(thread_id).thread_stats.disk.kb_rd_per_sec = float(values[18])
                 StatsProcessor.get_thread(thread_id).thread_stats.disk.kb_wr_per_sec = float(values[20])
                 StatsProcessor.get_thread(thread_id).update_name(str(values[26]))
-        return stats_by_tid
+        return thread_ids
 
 
 class StatsProcessor:
     threads = {}
+    sched_available = True
 
-    def __init__(self, params, stats_printer, stats_sorter, java_hotspot_handler):
+    SCHED_KEYS = (b"\nnr_voluntary_switches", b"\nnr_involuntary_switches", b"\nse.nr_migrations")
+    STATUS_KEYS = (b"\nvoluntary_ctxt_switches", b"\nnonvoluntary_ctxt_switches")
+
+    def __init__(self, params, stats_printer, stats_sorter, java_hotspot_handler, metrics_exporter=None,
+                 thread_state_sampler=None, cgroup_stats=None):
         self.max_stack_depth = params.max_stack_depth
         self.top_num = params.top_num
         self.stats_printer = stats_printer
         self.stats_sorter = stats_sorter
         self.java_hotspot_handler = java_hotspot_handler
+        self.metrics_exporter = metrics_exporter
+        self.thread_state_sampler = thread_state_sampler
+        self.cgroup_stats = cgroup_stats
+        self.cpu_heatmap = CPUHeatmap(params.numa_enabled) if params.view == 'cpu' else None
+        self.alert_engine = None
+        if len(params.alert_rules) > 0:
+            self.alert_engine = AlertEngine(params.alert_rules, params.snapshot_dir, params.alert_cooldown,
+                                            java_hotspot_handler)
 
     @staticmethod
     def get_thread(tid):
@@ -401,11 +687,40 @@ class StatsProcessor:
         return StatsProcessor.threads
 
     def process_stats(self, stat_lines, iter_num):
-        PidStatsParser.extract(stat_lines)
+        # threads that have finished are still in `threads` with their last stats
+        current_threads = [StatsProcessor.get_thread(tid) for tid in PidStatsParser.extract(stat_lines)]
         self.update_counters()
+        if self.cgroup_stats is not None:
+            self.update_cgroup_stats()
+        if self.thread_state_sampler is not None:
+            self.thread_state_sampler.collect()
+        if self.alert_engine is not None:
+            self.alert_engine.evaluate(current_threads, iter_num)
+        if self.cpu_heatmap is not None:
+            # neither the top threads nor their stacks are displayed in this view
+            if self.metrics_exporter is not None:
+                self.metrics_exporter.update(iter_num)
+            cpus, nodes = self.cpu_heatmap.aggregate(current_threads)
+            self.stats_printer.display_cpus(cpus, nodes, iter_num, self.cgroup_stats)
+            return
         top_n_threads = self.threads_for_sampling(self.top_num)
         self.load_stack_info(top_n_threads, self.max_stack_depth)
-        self.stats_printer.display(top_n_threads, iter_num)
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.update(iter_num)
+        self.stats_printer.display(top_n_threads, iter_num, self.cgroup_stats)
+
+    def update_cgroup_stats(self):
+        try:
+            self.cgroup_stats.update()
+        except OSError as exc:
+            # e.g. the cgroup was removed when the container was restarted
+            log_info("CPU throttling stats disabled, {} can't be read: {}", self.cgroup_stats.path, str(exc))
+            self.cgroup_stats.close()
+            self.cgroup_stats = None
+            for thread_info in StatsProcessor.get_all_threads().values():
+                thread_info.thread_stats.scheduler_stats.delta_throttled_time = 0
+            return
+        self.cgroup_stats.attribute_throttling(StatsProcessor.get_all_threads().values())
 
     @staticmethod
     def update_counters():
@@ -413,6 +728,10 @@ class StatsProcessor:
             on_cpu, on_runqueue, timeslices = StatsProcessor.calculate_scheduler_stats(thread_info.tid)
             if on_cpu is not None and on_runqueue is not None and timeslices is not None:
                 thread_info.thread_stats.scheduler_stats.update(on_cpu, on_runqueue, timeslices)
+            voluntary, involuntary, migrations = StatsProcessor.calculate_switch_stats(thread_info.tid)
+            if voluntary is not None and involuntary is not None:
+                thread_info.thread_stats.switches.update(voluntary, involuntary, migrations,
+                                                         thread_info.thread_stats.cpu.cpu)
 
     def load_stack_info(self, thread_ids, max_stack_depth):
         thread_info_by_id = self.java_hotspot_handler.stack_info(thread_ids, max_stack_depth)
@@ -438,6 +757,48 @@ class StatsProcessor:
         except FileNotFoundError:
             return None, None, None
 
+    @staticmethod
+    def calculate_switch_stats(tid):
+        """
+        Read the context switches and migrations from /proc/<pid>/task/<tid>/sched.
+        When it's not available (kernel without CONFIG_SCHED_DEBUG) the context
+        switches are taken from the status file and the migrations are unknown.
+        """
+        if StatsProcessor.sched_available:
+            try:
+                with open("/proc/{}/task/{}/sched".format(pid, tid), "rb") as sched:
+                    return StatsProcessor.find_values(sched.read(), StatsProcessor.SCHED_KEYS)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # the thread has finished (ESRCH when it finishes while reading)
+                return None, None, None
+        try:
+            with open("/proc/{}/task/{}/status".format(pid, tid), "rb") as status:
+                voluntary, involuntary = StatsProcessor.find_values(status.read(), StatsProcessor.STATUS_KEYS)
+        except OSError:
+            return None, None, None
+        if StatsProcessor.sched_available:
+            # the thread exists but not its sched file, don't look for it again
+            log_info("{} not available, CPU migrations are estimated from pidstat",
+                     "/proc/{}/task/{}/sched".format(pid, tid))
+            StatsProcessor.sched_available = False
+        return voluntary, involuntary, None
+
+    @staticmethod
+    def find_values(data, keys):
+        """Find the int value of each key in a "key: value" file, without parsing the rest of the lines."""
+        values = []
+        for key in keys:
+            start = data.find(key)
+            if start < 0:
+                values.append(None)
+                continue
+            start = data.index(b":", start) + 1
+            end = data.find(b"\n", start)
+            values.append(int(data[start:end if end >= 0 else len(data)]))
+        return values
+
 
 class JavaHotSpotHandler:
 
@@ -469,7 +830,10 @@ class JavaHotSpotHandler:
                         if thread_id in thread_set:
                             name_search = thread_dump.split('"')
                             name = name_search[1] if len(name_search) > 0 else "-name not found-"
-                            dump = os.linesep.join(thread_dump.split(os.linesep)[0:(2 + max_stack_depth)])
+                            dump_lines = thread_dump.split(os.linesep)
+                            if max_stack_depth is not None:
+                                dump_lines = dump_lines[0:(2 + max_stack_depth)]
+                            dump = os.linesep.join(dump_lines)
                             thread_by_tid[thread_id] = {
                                 'name': name,
                                 'dump': dump,
@@ -477,6 +841,930 @@ class JavaHotSpotHandler:
         return thread_by_tid
 
 
+class CgroupStats:
+    """
+    CFS throttling stats of the cgroup of the process, from the cpu controller
+    of cgroup v1 or from the unified hierarchy of cgroup v2.
+
+    The files are opened once and re-read from the start on each iteration.
+    """
+
+    def __init__(self, version, path):
+        self.version = version
+        self.path = path
+        self.__stat_fd = None
+        self.__quota_fds = []
+        try:
+            self.__stat_fd = os.open(os.path.join(path, "cpu.stat"), os.O_RDONLY)
+            if version == 1:
+                self.__quota_fds.append(os.open(os.path.join(path, "cpu.cfs_quota_us"), os.O_RDONLY))
+                self.__quota_fds.append(os.open(os.path.join(path, "cpu.cfs_period_us"), os.O_RDONLY))
+            else:
+                # there is no cpu.max in the root cgroup
+                cpu_max = os.path.join(path, "cpu.max")
+                if os.path.exists(cpu_max):
+                    self.__quota_fds.append(os.open(cpu_max, os.O_RDONLY))
+        except OSError:
+            self.close()
+            raise
+
+        self.__nr_periods = None
+        self.__nr_throttled = 0
+        self.__throttled_time = 0
+
+        self.delta_nr_periods = 0
+        self.delta_nr_throttled = 0
+        self.delta_throttled_time = 0
+        self.quota = None
+        self.period = None
+
+    @staticmethod
+    def find():
+        """Return the stats of the cgroup of the process or None when it can't be found."""
+        try:
+            with open("/proc/{}/cgroup".format(pid)) as cgroup_file:
+                cgroups = [line.strip().split(":", 2) for line in cgroup_file if line.count(":") >= 2]
+            with open("/proc/self/mountinfo") as mountinfo_file:
+                mounts = [line.split() for line in mountinfo_file]
+        except OSError as exc:
+            log_info("cgroup of the process can't be read: {}", str(exc))
+            return None
+        # with the hybrid layout the cpu controller is still on v1
+        for hierarchy_id, controllers, cgroup_path in cgroups:
+            if hierarchy_id != "0" and "cpu" in controllers.split(","):
+                path = CgroupStats.mounted_path(mounts, "cgroup", cgroup_path, "cpu")
+                if path is not None:
+                    return CgroupStats.open(1, path)
+        for hierarchy_id, controllers, cgroup_path in cgroups:
+            if hierarchy_id == "0":
+                path = CgroupStats.mounted_path(mounts, "cgroup2", cgroup_path, None)
+                if path is not None:
+                    return CgroupStats.open(2, path)
+        log_info("cgroup with the cpu controller not found for process {}", pid)
+        return None
+
+    @staticmethod
+    def mounted_path(mounts, fs_type, cgroup_path, controller):
+        for mount in mounts:
+            if "-" not in mount:
+                continue
+            separator = mount.index("-")
+            if len(mount) < separator + 4 or mount[separator + 1] != fs_type:
+                continue
+            if controller is not None and controller not in mount[separator + 3].split(","):
+                continue
+            root, mount_point = mount[3], mount[4]
+            if root != "/":
+                if cgroup_path != root and not cgroup_path.startswith(root + "/"):
+                    continue
+                cgroup_path = cgroup_path[len(root):]
+            return os.path.normpath(os.path.join(mount_point, cgroup_path.lstrip("/")))
+        return None
+
+    @staticmethod
+    def open(version, path):
+        try:
+            cgroup_stats = CgroupStats(version, path)
+            log_info("Reading CPU throttling from cgroup v{} in {}", version, path)
+            return cgroup_stats
+        except OSError as exc:
+            log_info("CPU throttling stats not available in {}: {}", path, str(exc))
+            return None
+
+    def update(self):
+        values = {}
+        for line in os.pread(self.__stat_fd, 4096, 0).decode().splitlines():
+            key, _, value = line.partition(" ")
+            values[key] = int(value)
+        nr_periods = values.get("nr_periods", 0)
+        nr_throttled = values.get("nr_throttled", 0)
+        if self.version == 1:
+            throttled_time = values.get("throttled_time", 0)
+        else:
+            throttled_time = values.get("throttled_usec", 0) * 1000
+
+        if self.__nr_periods is not None:
+            self.delta_nr_periods = nr_periods - self.__nr_periods
+            self.delta_nr_throttled = nr_throttled - self.__nr_throttled
+            self.delta_throttled_time = throttled_time - self.__throttled_time
+
+        self.__nr_periods = nr_periods
+        self.__nr_throttled = nr_throttled
+        self.__throttled_time = throttled_time
+
+        quota = [os.pread(fd, 64, 0).decode().split() for fd in self.__quota_fds]
+        if self.version == 1:
+            self.quota = int(quota[0][0]) if int(quota[0][0]) > 0 else None
+            self.period = int(quota[1][0])
+        elif len(quota) > 0:
+            self.quota = int(quota[0][0]) if quota[0][0] != "max" else None
+            self.period = int(quota[0][1])
+
+    def close(self):
+        if self.__stat_fd is not None:
+            os.close(self.__stat_fd)
+            self.__stat_fd = None
+        for fd in self.__quota_fds:
+            os.close(fd)
+        self.__quota_fds = []
+
+    def quota_cpus(self):
+        return self.quota / self.period if self.quota is not None and self.period else None
+
+    def attribute_throttling(self, threads):
+        """
+        Estimate the time each thread was throttled during the last iteration. Throttled threads
+        keep waiting on the run queue, so the throttled time is split proportionally to the
+        run-queue latency of each thread.
+        """
+        total_run_queue_latency = 0
+        for thread_info in threads:
+            scheduler_stats = thread_info.thread_stats.scheduler_stats
+            total_run_queue_latency += (scheduler_stats.delta_run_queue_latency *
+                                        max(scheduler_stats.delta_timeslices_on_current_cpu, 0))
+        for thread_info in threads:
+            scheduler_stats = thread_info.thread_stats.scheduler_stats
+            if self.delta_throttled_time > 0 and total_run_queue_latency > 0:
+                scheduler_stats.delta_throttled_time = (self.delta_throttled_time *
+                                                        scheduler_stats.delta_run_queue_latency *
+                                                        max(scheduler_stats.delta_timeslices_on_current_cpu, 0) /
+                                                        total_run_queue_latency)
+            else:
+                scheduler_stats.delta_throttled_time = 0
+
+    def description(self):
+        quota_cpus = self.quota_cpus()
+        quota = "quota {:.2f} CPUs".format(quota_cpus) if quota_cpus is not None else "no quota"
+        return "cgroup v{} {}: {}".format(self.version, self.path, quota)
+
+
+class MetricsExporter:
+    """
+    Serve the stats of the last iteration over HTTP in OpenMetrics text format.
+
+    The exposition body is rendered once per iteration (on `update`), so a scrape
+    only writes pre-rendered bytes no matter how often it comes.
+    Cardinality is bounded by `top_num`: only the top threads (or groups of threads
+    when `grouped` is on) according to the sort field are exported.
+    """
+
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    # name, type, help, aggregation within a group, getter over ThreadStats
+    METRICS = [
+        ("top_threads_cpu_percent", "gauge", "Total CPU usage (%CPU)", sum,
+         lambda s: s.cpu.total_cpu),
+        ("top_threads_cpu_user_percent", "gauge", "CPU usage at the user level (%usr)", sum,
+         lambda s: s.cpu.user_cpu),
+        ("top_threads_cpu_system_percent", "gauge", "CPU usage at the system level (%system)", sum,
+         lambda s: s.cpu.system_cpu),
+        ("top_threads_cpu_guest_percent", "gauge", "CPU usage running a virtual processor (%guest)", sum,
+         lambda s: s.cpu.guest_cpu),
+        ("top_threads_cpu_wait_percent", "gauge", "CPU usage waiting to run (%wait)", sum,
+         lambda s: s.cpu.wait_cpu),
+        ("top_threads_disk_read_bytes_per_second", "gauge", "Bytes read from disk per second", sum,
+         lambda s: s.disk.kb_rd_per_sec * 1024),
+        ("top_threads_disk_write_bytes_per_second", "gauge", "Bytes written to disk per second", sum,
+         lambda s: s.disk.kb_wr_per_sec * 1024),
+        ("top_threads_run_queue_latency_seconds", "gauge", "Avg. run-queue latency per timeslice", max,
+         lambda s: s.scheduler_stats.delta_run_queue_latency / 1e9),
+        ("top_threads_timeslices", "gauge", "Number of timeslices run in the last iteration", sum,
+         lambda s: s.scheduler_stats.delta_timeslices_on_current_cpu),
+        ("top_threads_voluntary_context_switches", "gauge", "Voluntary context switches in the last iteration",
+         sum, lambda s: s.switches.delta_voluntary_switches),
+        ("top_threads_involuntary_context_switches", "gauge", "Involuntary context switches in the last iteration",
+         sum, lambda s: s.switches.delta_involuntary_switches),
+        ("top_threads_cpu_migrations", "gauge", "CPU migrations in the last iteration", sum,
+         lambda s: s.switches.delta_migrations),
+        ("top_threads_cpu_seconds", "counter", "Time spent on the CPU", sum,
+         lambda s: s.scheduler_stats.spent_on_cpu / 1e9),
+        ("top_threads_run_queue_seconds", "counter", "Time spent waiting on a run queue", sum,
+         lambda s: s.scheduler_stats.run_queue_latency / 1e9),
+    ]
+
+    def __init__(self, port, top_num, grouped, stats_sorter):
+        self.port = port
+        self.top_num = top_num
+        self.grouped = grouped
+        self.stats_sorter = stats_sorter
+        self.body = b"# EOF\n"
+        self.server = None
+        self.server_thread = None
+
+    def start(self):
+        log_info("Serving OpenMetrics on http://127.0.0.1:{}/metrics", self.port)
+        self.server = MetricsHTTPServer(("127.0.0.1", self.port), MetricsRequestHandler)
+        self.server.metrics_exporter = self
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name="metrics-exporter", daemon=True)
+        self.server_thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            log_debug("Stopping OpenMetrics server on port {}", self.port)
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def update(self, iter_num):
+        threads = StatsProcessor.get_all_threads().values()
+        if self.grouped:
+            series = self.group_series(threads)
+        else:
+            series = self.thread_series(threads)
+        # the reference swap is atomic, scrapes see either the previous or the new body
+        self.body = self.render(series, iter_num, len(threads)).encode()
+
+    def thread_series(self, threads):
+        top = sorted(threads, key=self.stats_sorter, reverse=True)
+        top = top if self.top_num < 0 else top[0:self.top_num]
+        return [('pid="{}",tid="{}",name="{}"'.format(pid, t.tid, MetricsExporter.escape(t.name)), 1,
+                 [getter(t.thread_stats) for _, _, _, _, getter in MetricsExporter.METRICS])
+                for t in top]
+
+    def group_series(self, threads):
+        groups = {}
+        for thread_info in threads:
+            groups.setdefault(thread_info.group_name(), []).append(thread_info)
+        ranked = sorted(groups.items(), key=lambda item: sum(map(self.stats_sorter, item[1])), reverse=True)
+        ranked = ranked if self.top_num < 0 else ranked[0:self.top_num]
+        return [('pid="{}",group="{}"'.format(pid, MetricsExporter.escape(group)), len(members),
+                 [aggregation(getter(t.thread_stats) for t in members)
+                  for _, _, _, aggregation, getter in MetricsExporter.METRICS])
+                for group, members in ranked]
+
+    def render(self, series, iter_num, num_threads):
+        lines = [
+            "# TYPE top_threads_iteration gauge",
+            "# HELP top_threads_iteration Number of the last iteration",
+            'top_threads_iteration{{pid="{}"}} {}'.format(pid, iter_num),
+            "# TYPE top_threads_threads gauge",
+            "# HELP top_threads_threads Number of threads seen for the process",
+            'top_threads_threads{{pid="{}"}} {}'.format(pid, num_threads),
+        ]
+        if self.grouped:
+            lines.append("# TYPE top_threads_group_threads gauge")
+            lines.append("# HELP top_threads_group_threads Number of threads in the group")
+            for labels, size, _ in series:
+                lines.append("top_threads_group_threads{{{}}} {}".format(labels, size))
+        for index, (name, kind, description, _, _) in enumerate(MetricsExporter.METRICS):
+            sample_name = name + "_total" if kind == "counter" else name
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.append("# HELP {} {}".format(name, description))
+            for labels, _, values in series:
+                lines.append("{}{{{}}} {}".format(sample_name, labels, values[index]))
+        lines.append("# EOF\n")
+        return "\n".join(lines)
+
+    @staticmethod
+    def escape(label_value):
+        return label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    # same as http.server.ThreadingHTTPServer, which is only available since Python 3.7
+    daemon_threads = True
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics_exporter.body
+        self.send_response(200)
+        self.send_header("Content-Type", MetricsExporter.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # stderr would mess up the curses window
+        log_trace("Metrics request from {}: {}", self.address_string(), format % args)
+
+
+class ThreadStateSampler:
+    """
+    Poll the state field of /proc/<pid>/task/<tid>/stat in a background thread
+    at a high frequency and count how many times each thread was seen
+    running (R), sleeping (S) or in uninterruptible sleep (D).
+
+    The counters are double buffered: the sampler fills one set while the
+    main loop reads the other one. The stat files are read without holding
+    the lock, it only covers adding the states of a poll to the counters and
+    the swap of both sets in `collect`.
+    The stat files are kept open and re-read from the start on each poll.
+
+    A poll still holds the GIL while it parses the stat files (around 4 micros
+    per thread), which slows down the main loop. The frequency is lowered
+    automatically so that polling takes at most `MAX_BUSY_FRACTION` of the time,
+    e.g. with 1000 threads the sampler runs at ~25 Hz instead of 100 Hz.
+    """
+
+    RUNNING = 0
+    SLEEPING = 1
+    DISK_SLEEP = 2
+    OTHER = 3
+    SAMPLES = 4
+    STATE_INDEX = {ord('R'): RUNNING, ord('S'): SLEEPING, ord('D'): DISK_SLEEP}
+
+    # number of polls between two scans of /proc/<pid>/task looking for new threads
+    TASK_SCAN_POLLS = 20
+
+    # max fraction of the time spent polling
+    MAX_BUSY_FRACTION = 0.1
+
+    def __init__(self, frequency):
+        self.frequency = frequency
+        self.effective_frequency = frequency
+        self.logged_frequency = frequency
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.fds = {}
+        self.counters = {}
+        self.spare_counters = {}
+        self.wchans = {}
+        self.collected_tids = set()
+
+    def start(self):
+        log_info("Sampling thread states at {} Hz", self.frequency)
+        self.thread = threading.Thread(target=self.run, name="thread-state-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+
+    def run(self):
+        min_period = 1.0 / self.frequency
+        busy_time = 0.0
+        polls = 0
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            if polls % ThreadStateSampler.TASK_SCAN_POLLS == 0:
+                self.scan_tasks()
+            self.add_states(self.poll())
+            polls += 1
+            # smoothed time per poll, the period grows to keep the sampler under MAX_BUSY_FRACTION
+            elapsed = time.monotonic() - started
+            busy_time = elapsed if polls == 1 else 0.8 * busy_time + 0.2 * elapsed
+            period = max(min_period, busy_time / ThreadStateSampler.MAX_BUSY_FRACTION)
+            self.update_effective_frequency(1.0 / period)
+            delay = started + period - time.monotonic()
+            if delay > 0:
+                self.stopped.wait(delay)
+
+    def update_effective_frequency(self, frequency):
+        self.effective_frequency = frequency = min(int(frequency), self.frequency)
+        # log only the significant changes
+        if abs(frequency - self.logged_frequency) * 5 >= self.logged_frequency:
+            log_info("Sampling thread states at {} Hz ({} threads)", frequency, len(self.fds))
+            self.logged_frequency = frequency
+
+    def scan_tasks(self):
+        try:
+            tids = os.listdir("/proc/{}/task".format(pid))
+        except OSError:
+            return
+        for tid in tids:
+            tid = int(tid)
+            if tid not in self.fds:
+                try:
+                    self.fds[tid] = os.open("/proc/{}/task/{}/stat".format(pid, tid), os.O_RDONLY)
+                except OSError:
+                    pass
+
+    def poll(self):
+        """Read the state of each thread, returned as a list of (tid, state index, wchan)."""
+        states = []
+        finished = []
+        for tid, fd in self.fds.items():
+            try:
+                stat = os.pread(fd, 512, 0)
+            except OSError:
+                finished.append(tid)
+                continue
+            if not stat:
+                finished.append(tid)
+                continue
+            # the command may contain spaces or parenthesis, the state is right after the last ')'
+            state = stat[stat.rindex(b')') + 2]
+            index = ThreadStateSampler.STATE_INDEX.get(state, ThreadStateSampler.OTHER)
+            wchan = ThreadStateSampler.read_wchan(tid) if index == ThreadStateSampler.DISK_SLEEP else None
+            states.append((tid, index, wchan))
+        for tid in finished:
+            os.close(self.fds.pop(tid))
+        return states
+
+    def add_states(self, states):
+        with self.lock:
+            counters = self.counters
+            wchans = self.wchans
+            for tid, index, wchan in states:
+                thread_counters = counters.get(tid)
+                if thread_counters is None:
+                    thread_counters = counters[tid] = [0] * (ThreadStateSampler.SAMPLES + 1)
+                thread_counters[index] += 1
+                thread_counters[ThreadStateSampler.SAMPLES] += 1
+                if wchan is not None:
+                    wchans[tid] = wchan
+
+    @staticmethod
+    def read_wchan(tid):
+        try:
+            with open("/proc/{}/task/{}/wchan".format(pid, tid)) as wchan:
+                return wchan.read()
+        except OSError:
+            return None
+
+    def collect(self):
+        with self.lock:
+            counters, self.counters = self.counters, self.spare_counters
+            wchans, self.wchans = self.wchans, {}
+        for tid, thread_counters in counters.items():
+            StatsProcessor.get_thread(tid).thread_stats.state.update(thread_counters, wchans.get(tid))
+        # threads that weren't seen on this interval (e.g. they finished) must not keep the previous states
+        no_samples = [0] * (ThreadStateSampler.SAMPLES + 1)
+        for tid in self.collected_tids.difference(counters):
+            StatsProcessor.get_thread(tid).thread_stats.state.update(no_samples, None)
+        self.collected_tids = set(counters)
+        # keep the counters of the live threads to be reused on the next interval
+        self.spare_counters = {tid: thread_counters for tid, thread_counters in counters.items()
+                               if thread_counters[ThreadStateSampler.SAMPLES] > 0}
+        for thread_counters in self.spare_counters.values():
+            for index in range(len(thread_counters)):
+                thread_counters[index] = 0
+
+
+class CPUStats:
+    """
+    Stats of the threads of the process that have run on a CPU (or on a NUMA node)
+    during the last iteration.
+    """
+
+    # %CPU from which a thread is considered hot
+    HOT_THREAD_CPU = 20
+
+    def __init__(self, label, cpus=None):
+        self.label = label
+        self.cpus = cpus
+        self.total_cpu = 0.0
+        self.max_run_queue_latency = 0
+        self.threads = 0
+        self.hot_threads = 0
+        self.hottest_thread = None
+
+    def add(self, thread_info):
+        cpu_stats = thread_info.thread_stats.cpu
+        self.threads += 1
+        self.total_cpu += cpu_stats.total_cpu
+        if cpu_stats.total_cpu >= CPUStats.HOT_THREAD_CPU:
+            self.hot_threads += 1
+        self.max_run_queue_latency = max(self.max_run_queue_latency,
+                                         thread_info.thread_stats.scheduler_stats.delta_run_queue_latency)
+        if self.hottest_thread is None or cpu_stats.total_cpu > self.hottest_thread.thread_stats.cpu.total_cpu:
+            self.hottest_thread = thread_info
+
+    def is_contended(self):
+        """Whether there are more hot threads than CPUs to run them."""
+        return self.hot_threads > (len(self.cpus) if self.cpus else 1)
+
+
+class CPUHeatmap:
+    """
+    Aggregate the stats of the threads per logical CPU, the one where each thread
+    ran last according to pidstat, and optionally per NUMA node.
+    """
+
+    def __init__(self, numa_enabled):
+        self.num_cpus = os.cpu_count() or 1
+        self.node_by_cpu = CPUHeatmap.load_numa_nodes() if numa_enabled else {}
+        log_debug("NUMA nodes by CPU: {}", self.node_by_cpu)
+
+    @staticmethod
+    def load_numa_nodes():
+        node_by_cpu = {}
+        try:
+            entries = os.listdir("/sys/devices/system/node")
+        except FileNotFoundError:
+            log_info("NUMA info is not available in /sys/devices/system/node")
+            return node_by_cpu
+        for entry in entries:
+            if re.match(r"node\d+$", entry):
+                with open("/sys/devices/system/node/{}/cpulist".format(entry)) as cpulist:
+                    for cpu in CPUHeatmap.parse_cpu_list(cpulist.read()):
+                        node_by_cpu[cpu] = int(entry[4:])
+        return node_by_cpu
+
+    @staticmethod
+    def parse_cpu_list(cpu_list):
+        """Parse a list of CPUs in the format used by sysfs, e.g. "0-3,8-11"."""
+        cpus = []
+        for cpu_range in cpu_list.strip().split(','):
+            if '-' in cpu_range:
+                first, last = cpu_range.split('-')
+                cpus.extend(range(int(first), int(last) + 1))
+            elif cpu_range:
+                cpus.append(int(cpu_range))
+        return cpus
+
+    def aggregate(self, threads):
+        cpus = [CPUStats("CPU {:3d}".format(cpu)) for cpu in range(self.num_cpus)]
+        for thread_info in threads:
+            if thread_info.thread_stats.cpu.total_cpu <= 0 and \
+                    thread_info.thread_stats.scheduler_stats.delta_timeslices_on_current_cpu <= 0:
+                continue
+            try:
+                cpu = int(str(thread_info.thread_stats.cpu.cpu).strip())
+            except ValueError:
+                continue
+            while cpu >= len(cpus):
+                cpus.append(CPUStats("CPU {:3d}".format(len(cpus))))
+            cpus[cpu].add(thread_info)
+        nodes = []
+        if self.node_by_cpu:
+            cpus_by_node = {}
+            for cpu, node in sorted(self.node_by_cpu.items()):
+                cpus_by_node.setdefault(node, []).append(cpu)
+            for node, node_cpus in sorted(cpus_by_node.items()):
+                node_stats = CPUStats("Node {}".format(node), node_cpus)
+                for cpu in node_cpus:
+                    if cpu < len(cpus):
+                        cpu_stats = cpus[cpu]
+                        node_stats.threads += cpu_stats.threads
+                        node_stats.hot_threads += cpu_stats.hot_threads
+                        node_stats.total_cpu += cpu_stats.total_cpu
+                        node_stats.max_run_queue_latency = max(node_stats.max_run_queue_latency,
+                                                               cpu_stats.max_run_queue_latency)
+                nodes.append(node_stats)
+            for cpu, cpu_stats in enumerate(cpus):
+                if cpu in self.node_by_cpu:
+                    cpu_stats.label = "{} (node {})".format(cpu_stats.label, self.node_by_cpu[cpu])
+        return cpus, nodes
+
+    @staticmethod
+    def bar(total_cpu, width=20):
+        filled = int(round(min(total_cpu, 100.0) * width / 100.0))
+        return "[{}{}]".format("#" * filled, "." * (width - filled))
+
+
+class AlertRule:
+    """
+    A condition over a field of the thread stats, like "total_cpu > 90 for 3 samples"
+    or "delta_run_queue_latency > 1ms", compiled once into a getter, an operator
+    and a threshold so it's cheap to check against every thread on each iteration.
+    """
+
+    PATTERN = re.compile(r"^\s*(?P<field>\w+)\s*(?P<op>>=|<=|==|!=|>|<)\s*(?P<value>\d+(\.\d*)?)\s*(?P<unit>[a-z%]*)"
+                         r"(\s+for\s+(?P<samples>\d+)\s+samples?)?\s*$")
+
+    OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le,
+                 '==': operator.eq, '!=': operator.ne}
+
+    PERCENT_UNITS = {'': 1, '%': 1}
+    TIME_UNITS = {'': 1, 'ns': 1, 'us': 1000, 'ms': 1000000, 's': 1000000000}
+    COUNT_UNITS = {'': 1}
+
+    FIELDS = {
+        'total_cpu': ('thread_stats.cpu.total_cpu', PERCENT_UNITS),
+        'user_cpu': ('thread_stats.cpu.user_cpu', PERCENT_UNITS),
+        'system_cpu': ('thread_stats.cpu.system_cpu', PERCENT_UNITS),
+        'guest_cpu': ('thread_stats.cpu.guest_cpu', PERCENT_UNITS),
+        'wait_cpu': ('thread_stats.cpu.wait_cpu', PERCENT_UNITS),
+        'kb_rd_per_sec': ('thread_stats.disk.kb_rd_per_sec', COUNT_UNITS),
+        'kb_wr_per_sec': ('thread_stats.disk.kb_wr_per_sec', COUNT_UNITS),
+        'delta_spent_on_cpu': ('thread_stats.scheduler_stats.delta_spent_on_cpu', TIME_UNITS),
+        'delta_run_queue_latency': ('thread_stats.scheduler_stats.delta_run_queue_latency', TIME_UNITS),
+        'delta_timeslices_on_current_cpu': ('thread_stats.scheduler_stats.delta_timeslices_on_current_cpu',
+                                            COUNT_UNITS),
+        'delta_voluntary_switches': ('thread_stats.switches.delta_voluntary_switches', COUNT_UNITS),
+        'delta_involuntary_switches': ('thread_stats.switches.delta_involuntary_switches', COUNT_UNITS),
+        'delta_migrations': ('thread_stats.switches.delta_migrations', COUNT_UNITS),
+        'delta_throttled_time': ('thread_stats.scheduler_stats.delta_throttled_time', TIME_UNITS),
+        'running': ('thread_stats.state.running', PERCENT_UNITS),
+        'sleeping': ('thread_stats.state.sleeping', PERCENT_UNITS),
+        'disk_sleep': ('thread_stats.state.disk_sleep', PERCENT_UNITS),
+    }
+
+    def __init__(self, text, getter, compare, threshold, samples):
+        self.text = text
+        self.getter = getter
+        self.compare = compare
+        self.threshold = threshold
+        self.samples = samples
+        self.last_fired = None
+        self.__matches_by_tid = {}
+
+    @staticmethod
+    def compile(text):
+        match = AlertRule.PATTERN.match(text)
+        if match is None:
+            raise ValueError("invalid alert rule '{}', expected '<field> <op> <value>[unit] [for <n> samples]'"
+                             .format(text))
+        field = match.group('field')
+        if field not in AlertRule.FIELDS:
+            raise ValueError("unknown field '{}' in alert rule '{}', expected one of: {}"
+                             .format(field, text, ", ".join(sorted(AlertRule.FIELDS))))
+        path, units = AlertRule.FIELDS[field]
+        unit = match.group('unit')
+        if unit not in units:
+            raise ValueError("invalid unit '{}' in alert rule '{}'".format(unit, text))
+        threshold = float(match.group('value')) * units[unit]
+        samples = int(match.group('samples')) if match.group('samples') is not None else 1
+        if samples < 1:
+            raise ValueError("the number of samples must be positive in alert rule '{}'".format(text))
+        return AlertRule(text.strip(), operator.attrgetter(path), AlertRule.OPERATORS[match.group('op')],
+                         threshold, samples)
+
+    def matching_threads(self, threads):
+        """Return the threads that matched the condition on the last `samples` iterations."""
+        getter, compare, threshold, samples = self.getter, self.compare, self.threshold, self.samples
+        previous_matches = self.__matches_by_tid
+        matches_by_tid = {}
+        result = []
+        for thread_info in threads:
+            if compare(getter(thread_info), threshold):
+                matches = previous_matches.get(thread_info.tid, 0) + 1
+                matches_by_tid[thread_info.tid] = matches
+                if matches >= samples:
+                    result.append(thread_info)
+        self.__matches_by_tid = matches_by_tid
+        return result
+
+
+class AlertEngine:
+    """
+    Evaluate the alert rules on each iteration and save a snapshot of all the threads,
+    with the full stack traces when jstack can be used, when one of them fires.
+    Each rule fires at most once per `cooldown` seconds.
+    """
+
+    def __init__(self, rules, snapshot_dir, cooldown, java_hotspot_handler):
+        self.rules = rules
+        self.snapshot_dir = snapshot_dir
+        self.cooldown = cooldown
+        self.java_hotspot_handler = java_hotspot_handler
+
+    def evaluate(self, threads, iter_num):
+        """Evaluate the rules on the threads reported on the iteration."""
+        now = time.monotonic()
+        fired_rules = []
+        for rule in self.rules:
+            matching_threads = rule.matching_threads(threads)
+            if len(matching_threads) > 0 and (rule.last_fired is None or now - rule.last_fired >= self.cooldown):
+                rule.last_fired = now
+                fired_rules.append((rule, matching_threads))
+        if len(fired_rules) > 0:
+            self.capture_snapshot(threads, fired_rules, iter_num)
+
+    def capture_snapshot(self, threads, fired_rules, iter_num):
+        """Save a single snapshot for all the rules fired on the iteration."""
+        now = datetime.datetime.now()
+        path = os.path.join(self.snapshot_dir,
+                            "top-threads-{}-{}-{}.txt".format(pid, now.strftime("%Y%m%d-%H%M%S"), iter_num))
+        threads = sorted(threads, key=lambda x: x.thread_stats.cpu.total_cpu, reverse=True)
+        thread_info_by_id = self.java_hotspot_handler.stack_info([t.tid for t in threads], None)
+        try:
+            with open(path, "w") as snapshot:
+                snapshot.write("Alerts fired at {} (iteration #{}) for process {}\n".format(now, iter_num, pid))
+                for rule, matching_threads in fired_rules:
+                    snapshot.write("Alert '{}' matching threads: {}\n"
+                                   .format(rule.text,
+                                           ", ".join("tid {} \"{}\"".format(t.tid, t.name) for t in matching_threads)))
+                snapshot.write("\n")
+                for thread_info in threads:
+                    dump = thread_info_by_id.get(thread_info.tid, {}).get('dump', 'no dump provided')
+                    snapshot.write(AlertEngine.format_thread(thread_info, dump))
+        except OSError as exc:
+            # e.g. the directory was removed or the disk is full, the next alerts may still be saved
+            for rule, matching_threads in fired_rules:
+                log_info("Alert '{}' fired by {} thread(s), snapshot {} can't be saved: {}",
+                         rule.text, len(matching_threads), path, str(exc))
+            return
+        for rule, matching_threads in fired_rules:
+            log_info("Alert '{}' fired by {} thread(s), snapshot saved in {}", rule.text, len(matching_threads), path)
+
+    @staticmethod
+    def format_thread(thread_info, dump):
+        stats = thread_info.thread_stats
+        lines = [
+            "Thread [tid {} CPU #{}] \"{}\"".format(thread_info.tid, stats.cpu.cpu, thread_info.name),
+            "CPU {:3.2f}% [%usr: {:3.2f}, %system: {:3.2f}, %guest: {:3.2f}, %wait: {:3.2f}] "
+            "[avg. time spent in CPU: {}, avg. run-queue latency: {}, # of timeslices run in current CPU: {}]"
+                .format(stats.cpu.total_cpu, stats.cpu.user_cpu, stats.cpu.system_cpu, stats.cpu.guest_cpu,
+                        stats.cpu.wait_cpu, StatsTerminalPrinter.nanos_fmt(stats.scheduler_stats.delta_spent_on_cpu),
+                        StatsTerminalPrinter.nanos_fmt(stats.scheduler_stats.delta_run_queue_latency),
+                        stats.scheduler_stats.delta_timeslices_on_current_cpu),
+            "I/O disk [kB_rd/s: {}, kB_wr/s: {}]".format(stats.disk.kb_rd_per_sec, stats.disk.kb_wr_per_sec),
+            "Context switches [voluntary: {}, involuntary: {}, CPU migrations: {}]"
+                .format(stats.switches.delta_voluntary_switches, stats.switches.delta_involuntary_switches,
+                        stats.switches.delta_migrations),
+        ]
+        if stats.state.samples > 0:
+            lines.append("State [R: {:3.1f}%, S: {:3.1f}%, D: {:3.1f}%, other: {:3.1f}%]"
+                         .format(stats.state.running, stats.state.sleeping, stats.state.disk_sleep, stats.state.other))
+        lines.append(dump)
+        return os.linesep.join(lines) + os.linesep * 2
+
+
+class PidStatsLogReader:
+    """
+    Stream the thread stats from a log saved from `pidstat -u -d -t -h`, as
+    (iteration, name, %CPU, %wait, kB_rd/s, kB_wr/s), one line at a time.
+
+    The source is FILE or FILE:FIRST-LAST to read only a range of iterations
+    (1-based, both ends optional). The columns are taken from the header, so
+    logs from old and new versions of systat are supported.
+    """
+
+    RANGE_PATTERN = re.compile(r"^(?P<path>.+):(?P<first>\d*)-(?P<last>\d*)$")
+
+    def __init__(self, source):
+        self.source = source
+        self.first = 1
+        self.last = None
+        match = PidStatsLogReader.RANGE_PATTERN.match(source)
+        if match is not None and not os.path.exists(source):
+            self.path = match.group('path')
+            self.first = int(match.group('first')) if match.group('first') else 1
+            self.last = int(match.group('last')) if match.group('last') else None
+        else:
+            self.path = source
+
+    def __iter__(self):
+        columns = None
+        iteration = 0
+        last_time = None
+        with open(self.path) as log_file:
+            for line in log_file:
+                values = line.split()
+                if len(values) == 0 or values[0] == "Average:":
+                    continue
+                if values[0] == "#":
+                    columns = {column: index for index, column in enumerate(values[1:])}
+                    continue
+                if columns is None:
+                    # the line with the system info or garbage before the first header
+                    continue
+                if len(values) > 1 and values[1] in ("AM", "PM"):
+                    values[0:2] = [values[0] + values[1]]
+                if len(values) < len(columns):
+                    continue
+                # only thread rows: the process row has TID "-" (new versions) or "0" (old versions)
+                tid = values[columns['TID']]
+                if not tid.isdigit() or int(tid) == 0:
+                    continue
+                if 'TGID' in columns and values[columns['TGID']] not in ('-', '0'):
+                    continue
+                if values[0] != last_time:
+                    last_time = values[0]
+                    iteration += 1
+                    if self.last is not None and iteration > self.last:
+                        return
+                if iteration < self.first:
+                    continue
+                name = " ".join(values[columns['Command']:])
+                if name.startswith("|__"):
+                    name = name[3:]
+                yield (iteration,
+                       name,
+                       float(values[columns['%CPU']]),
+                       float(values[columns['%wait']]) if '%wait' in columns else 0.0,
+                       float(values[columns['kB_rd/s']]) if 'kB_rd/s' in columns else 0.0,
+                       float(values[columns['kB_wr/s']]) if 'kB_wr/s' in columns else 0.0)
+
+
+class StreamingHistogram:
+    """
+    Histogram with fixed bucket bounds and sparse counters to approximate
+    percentiles with bounded memory no matter how many values are added.
+    """
+
+    # linear buckets of 0.5% for %CPU and %wait
+    PERCENT_BOUNDS = [i / 2.0 for i in range(0, 201)]
+    # exponential buckets for kB/s
+    RATE_BOUNDS = [0.0] + [2.0 ** i for i in range(0, 31)]
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = {}
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket where the percentile falls (or the max value)."""
+        if self.count == 0:
+            return 0.0
+        rank = percent * self.count / 100.0
+        accumulated = 0
+        for index in sorted(self.counts):
+            accumulated += self.counts[index]
+            if accumulated >= rank:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+
+class SessionStats:
+    """Histograms of the stats of each thread (or group of threads) in a session."""
+
+    METRICS = ['cpu', 'wait', 'disk_rd', 'disk_wr']
+
+    def __init__(self):
+        self.iterations = 0
+        self.histograms_by_key = {}
+
+    @staticmethod
+    def load(reader, key):
+        session = SessionStats()
+        for iteration, name, total_cpu, wait_cpu, kb_rd_per_sec, kb_wr_per_sec in reader:
+            thread_key = (thread_group_pattern.sub("", name) or name) if key == 'group' else name
+            histograms = session.histograms_by_key.get(thread_key)
+            if histograms is None:
+                histograms = session.histograms_by_key[thread_key] = SessionStats.new_histograms()
+            histograms['cpu'].add(total_cpu)
+            histograms['wait'].add(wait_cpu)
+            histograms['disk_rd'].add(kb_rd_per_sec)
+            histograms['disk_wr'].add(kb_wr_per_sec)
+            session.iterations = iteration
+        log_debug("Loaded {} threads from {} until iteration {}",
+                  len(session.histograms_by_key), reader.path, session.iterations)
+        return session
+
+    @staticmethod
+    def new_histograms():
+        return {
+            'cpu': StreamingHistogram(StreamingHistogram.PERCENT_BOUNDS),
+            'wait': StreamingHistogram(StreamingHistogram.PERCENT_BOUNDS),
+            'disk_rd': StreamingHistogram(StreamingHistogram.RATE_BOUNDS),
+            'disk_wr': StreamingHistogram(StreamingHistogram.RATE_BOUNDS),
+        }
+
+
+class SessionDiff:
+    """
+    Rank the threads of two sessions by the change of the p95 of the sort field.
+    pidstat logs don't include the run-queue latency, %wait (time waiting to run)
+    is used instead.
+    """
+
+    PERCENTILES = [50, 95, 99]
+
+    # pidstat logs have neither the context switches nor the throttling
+    SORT_FIELDS = ['cpu', 'rq', 'disk', 'disk-rd', 'disk-wr']
+
+    def __init__(self, session_a, session_b, field_sort):
+        self.session_a = session_a
+        self.session_b = session_b
+        if field_sort == "rq":
+            self.description = 'Ranking by %wait (p95)'
+            self.metrics = ['wait']
+        elif field_sort == "disk":
+            self.description = 'Ranking by Disk (read/sec + write/sec, p95)'
+            self.metrics = ['disk_rd', 'disk_wr']
+        elif field_sort == "disk-rd":
+            self.description = 'Ranking by Disk (read/sec, p95)'
+            self.metrics = ['disk_rd']
+        elif field_sort == "disk-wr":
+            self.description = 'Ranking by Disk (write/sec, p95)'
+            self.metrics = ['disk_wr']
+        else:
+            self.description = 'Ranking by CPU (p95)'
+            self.metrics = ['cpu']
+
+    def ranking(self, top_num):
+        """
+        Return the top threads that got hotter as a list of
+        (key, samples A, samples B, {metric: [(percentile, value A, value B)]}).
+        """
+        empty = SessionStats.new_histograms()
+        rows = []
+        for key in set(self.session_a.histograms_by_key) | set(self.session_b.histograms_by_key):
+            histograms_a = self.session_a.histograms_by_key.get(key, empty)
+            histograms_b = self.session_b.histograms_by_key.get(key, empty)
+            percentiles = {metric: [(percent, histograms_a[metric].percentile(percent),
+                                     histograms_b[metric].percentile(percent))
+                                    for percent in SessionDiff.PERCENTILES]
+                           for metric in SessionStats.METRICS}
+            change = sum(percentiles[metric][1][2] - percentiles[metric][1][1] for metric in self.metrics)
+            rows.append((change, key, histograms_a['cpu'].count, histograms_b['cpu'].count, percentiles))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        rows = rows if top_num < 0 else rows[0:top_num]
+        return [row[1:] for row in rows]
+
+
 class StatsRefreshPrinter:
 
     def __init__(self, title):
@@ -484,7 +1772,7 @@ class StatsRefreshPrinter:
         self.title = title
 
     def __enter__(self):
-        log_debug("Initializing StatsRefreshPrinter({})".format(self.title))
+        log_debug("Initializing StatsRefreshPrinter({})", self.title)
         self.stdscr = curses.initscr()
         curses.noecho()
         curses.cbreak()
@@ -496,21 +1784,21 @@ class StatsRefreshPrinter:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        log_debug("Closing StatsRefreshPrinter({})".format(self.title))
+        log_debug("Closing StatsRefreshPrinter({})", self.title)
         curses.echo()
         curses.nocbreak()
         curses.endwin()
 
-    def display(self, top_n_threads, iter_num):
+    def display(self, top_n_threads, iter_num, cgroup_stats=None):
         stdscr = self.stdscr
         stdscr.scrollok(1)
         stdscr.idlok(1)
 
         max_lines, max_x = stdscr.getmaxyx()
 
-        current_position = 2
+        lines = StatsRefreshPrinter.cgroup_lines(cgroup_stats)
+        current_position = 2 + len(lines)
 
-        lines = []
         for tid in top_n_threads:
             thread_lines, current_position = StatsRefreshPrinter.next_line(current_position, max_lines,
                                                                            StatsProcessor.get_thread(tid))
@@ -520,6 +1808,53 @@ class StatsRefreshPrinter:
         StatsRefreshPrinter.display_lines(self.stdscr, self.title, lines, iter_num=iter_num)
         stdscr.refresh()
 
+    def display_cpus(self, cpus, nodes, iter_num, cgroup_stats=None):
+        stdscr = self.stdscr
+        stdscr.scrollok(1)
+        stdscr.idlok(1)
+
+        lines = StatsRefreshPrinter.cgroup_lines(cgroup_stats)
+        lines.extend(StatsRefreshPrinter.cpu_line(node_stats) for node_stats in nodes)
+        if len(nodes) > 0:
+            lines.append([ChunkText("")])
+        lines.extend(StatsRefreshPrinter.cpu_line(cpu_stats) for cpu_stats in cpus)
+        StatsRefreshPrinter.display_lines(self.stdscr, self.title, lines, iter_num=iter_num)
+        stdscr.refresh()
+
+    @staticmethod
+    def cgroup_lines(cgroup_stats):
+        if cgroup_stats is None:
+            return []
+        throttled = cgroup_stats.delta_nr_throttled > 0
+        line = [ChunkText("{} | throttled ".format(cgroup_stats.description()))]
+        line.append(ChunkText("{}".format(cgroup_stats.delta_nr_throttled),
+                              curses.color_pair(2) if throttled else curses.color_pair(1)))
+        line.append(ChunkText(" of {} periods for ".format(cgroup_stats.delta_nr_periods)))
+        line.append(ChunkText(StatsRefreshPrinter.nanos_fmt(cgroup_stats.delta_throttled_time),
+                              curses.color_pair(2) if throttled else curses.color_pair(1)))
+        return [line, [ChunkText("")]]
+
+    @staticmethod
+    def cpu_line(cpu_stats):
+        contended = cpu_stats.is_contended()
+        line = [ChunkText("{} ".format(cpu_stats.label), curses.A_BOLD)]
+        line.append(ChunkText(CPUHeatmap.bar(cpu_stats.total_cpu), StatsRefreshPrinter.cpu_color(cpu_stats.total_cpu)))
+        line.append(ChunkText(" {:6.2f}%".format(cpu_stats.total_cpu),
+                              StatsRefreshPrinter.cpu_color(cpu_stats.total_cpu)))
+        line.append(ChunkText(" | threads: {} (hot: ".format(cpu_stats.threads)))
+        line.append(ChunkText("{}".format(cpu_stats.hot_threads),
+                              curses.color_pair(2) | curses.A_BOLD if contended else 0))
+        line.append(ChunkText(") | max run-queue latency: "))
+        line.append(ChunkText(StatsRefreshPrinter.nanos_fmt(cpu_stats.max_run_queue_latency),
+                              StatsRefreshPrinter.latency_color(cpu_stats.max_run_queue_latency)))
+        if cpu_stats.hottest_thread is not None:
+            line.append(ChunkText(" | hottest: tid {} \"{}\" {:3.2f}%"
+                                  .format(cpu_stats.hottest_thread.tid, cpu_stats.hottest_thread.name,
+                                          cpu_stats.hottest_thread.thread_stats.cpu.total_cpu)))
+        if contended:
+            line.append(ChunkText(" << contention", curses.color_pair(2) | curses.A_BOLD))
+        return line
+
     @staticmethod
     def display_lines(stdscr, header_text, lines, iter_num, encoding="utf-8"):
         try:
@@ -542,7 +1877,7 @@ class StatsRefreshPrinter:
             out.refresh()
             return out
         except curses.error as exc:
-            log_debug("Error raised by curses: {} (an error here is expected when the terminal resize)".format(exc))
+            log_debug("Error raised by curses: {} (an error here is expected when the terminal resize)", str(exc))
             pass
 
     @staticmethod
@@ -561,7 +1896,7 @@ class StatsRefreshPrinter:
         new_line = []
         while queue:
             next_chunk = queue.popleft()
-            # log_info("chunk: {}".format(next_chunk))
+            # log_info("chunk: {}", next_chunk)
             if len(next_chunk.text) + carry > max_columns:
                 new_line.append(ChunkText(next_chunk.text[0:max_columns - carry], next_chunk.attr))
                 result_lines.append(new_line)
@@ -638,7 +1973,22 @@ class StatsRefreshPrinter:
                     thread_info.thread_stats.scheduler_stats.delta_run_queue_latency)))
         new_line.append(ChunkText(", # of timeslices run in current CPU: "))
         new_line.append(ChunkText("{}".format(thread_info.thread_stats.scheduler_stats.delta_timeslices_on_current_cpu)))
+        if thread_info.thread_stats.scheduler_stats.delta_throttled_time > 0:
+            new_line.append(ChunkText(", est. throttled: "))
+            new_line.append(
+                ChunkText(StatsRefreshPrinter.nanos_fmt(thread_info.thread_stats.scheduler_stats.delta_throttled_time),
+                          curses.color_pair(2)))
         new_line.append(ChunkText("]"))
+        state = thread_info.thread_stats.state
+        if state.samples > 0:
+            new_line.append(ChunkText(" [state R: "))
+            new_line.append(ChunkText("{:3.1f}%".format(state.running), StatsRefreshPrinter.cpu_color(state.running)))
+            new_line.append(ChunkText(", S: {:3.1f}%, D: ".format(state.sleeping)))
+            new_line.append(ChunkText("{:3.1f}%".format(state.disk_sleep),
+                                      StatsRefreshPrinter.cpu_color(state.disk_sleep)))
+            if state.wchan:
+                new_line.append(ChunkText(" (wchan: {})".format(state.wchan)))
+            new_line.append(ChunkText(", other: {:3.1f}%]".format(state.other)))
 
         lines.append(new_line)
 
@@ -656,6 +2006,23 @@ class StatsRefreshPrinter:
         new_line.append(ChunkText("]"))
         lines.append(new_line)
 
+        position += 1
+        if position >= max_lines:
+            return lines, position
+
+        new_line = []
+        new_line.append(ChunkText("Context switches [voluntary: "))
+        new_line.append(ChunkText("{}".format(thread_info.thread_stats.switches.delta_voluntary_switches)))
+        new_line.append(ChunkText(", involuntary: "))
+        new_line.append(
+            ChunkText("{}".format(thread_info.thread_stats.switches.delta_involuntary_switches),
+                      StatsRefreshPrinter.switch_color(thread_info.thread_stats.switches.delta_involuntary_switches)))
+        new_line.append(ChunkText(", CPU migrations: "))
+        new_line.append(ChunkText("{}".format(thread_info.thread_stats.switches.delta_migrations),
+                                  StatsRefreshPrinter.switch_color(thread_info.thread_stats.switches.delta_migrations)))
+        new_line.append(ChunkText("]"))
+        lines.append(new_line)
+
         for line in thread_info.dump.split(os.linesep):
             lines.append([ChunkText(line)])
             position += 1
@@ -694,6 +2061,15 @@ class StatsRefreshPrinter:
         else:
             return curses.color_pair(2)
 
+    @staticmethod
+    def switch_color(value):
+        if value < 100:
+            return curses.color_pair(1)
+        elif value < 1000:
+            return curses.color_pair(3)
+        else:
+            return curses.color_pair(2)
+
     @staticmethod
     def sizeof_fmt(num, suffix='B'):
         for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
@@ -711,6 +2087,18 @@ class StatsRefreshPrinter:
         return "%.1f%s" % (num, ' seconds')
 
 
+class NanosFmt:
+    """Defer the formatting of a time in nanos until the log message is emitted."""
+
+    __slots__ = ('nanos',)
+
+    def __init__(self, nanos):
+        self.nanos = nanos
+
+    def __format__(self, format_spec):
+        return StatsRefreshPrinter.nanos_fmt(self.nanos)
+
+
 class ChunkText:
 
     def __init__(self, text, attr=0):
@@ -734,14 +2122,82 @@ class StatsTerminalPrinter:
     def __init__(self, title):
         self.title = title
 
-    def display(self, top_n_threads, iter_num):
+    def display(self, top_n_threads, iter_num, cgroup_stats=None):
         print(StatsTerminalPrinter.colored('-------------------------- Iteration #{:5d}'.format(iter_num),
                                            BColors.HEADER))
         print(StatsTerminalPrinter.colored(self.title, BColors.HEADER))
+        self.cgroup_line(cgroup_stats)
 
         for tid in top_n_threads:
             self.next_line(StatsProcessor.get_thread(tid))
 
+    def display_diff(self, rows):
+        print(StatsTerminalPrinter.colored(self.title, BColors.HEADER))
+        print('')
+        labels = {'cpu': '%CPU   ', 'wait': '%wait  ', 'disk_rd': 'kB_rd/s', 'disk_wr': 'kB_wr/s'}
+        for key, samples_a, samples_b, percentiles in rows:
+            print(StatsTerminalPrinter.colored("Thread \"{}\" [samples A: {}, B: {}]".format(key, samples_a, samples_b),
+                                               BColors.BOLD))
+            for metric in SessionStats.METRICS:
+                print("  {}".format(labels[metric]), end='')
+                for percent, value_a, value_b in percentiles[metric]:
+                    change = value_b - value_a
+                    print(" | p{}: {:8.2f} -> {:8.2f} (".format(percent, value_a, value_b), end='')
+                    if change == 0:
+                        print("{:+8.2f}".format(change), end='')
+                    else:
+                        print(StatsTerminalPrinter.colored("{:+8.2f}".format(change),
+                                                           BColors.FAIL if change > 0 else BColors.OKGREEN), end='')
+                    print(")", end='')
+                print('')
+            print('')
+
+    def display_cpus(self, cpus, nodes, iter_num, cgroup_stats=None):
+        print(StatsTerminalPrinter.colored('-------------------------- Iteration #{:5d}'.format(iter_num),
+                                           BColors.HEADER))
+        print(StatsTerminalPrinter.colored(self.title, BColors.HEADER))
+        self.cgroup_line(cgroup_stats)
+
+        for node_stats in nodes:
+            self.cpu_line(node_stats)
+        if len(nodes) > 0:
+            print('')
+        for cpu_stats in cpus:
+            self.cpu_line(cpu_stats)
+        print('')
+
+    def cgroup_line(self, cgroup_stats):
+        if cgroup_stats is None:
+            return
+        color = BColors.FAIL if cgroup_stats.delta_nr_throttled > 0 else BColors.OKGREEN
+        print("{} | throttled ".format(cgroup_stats.description()), end='')
+        print(StatsTerminalPrinter.colored("{}".format(cgroup_stats.delta_nr_throttled), color), end='')
+        print(" of {} periods for ".format(cgroup_stats.delta_nr_periods), end='')
+        print(StatsTerminalPrinter.colored(self.nanos_fmt(cgroup_stats.delta_throttled_time), color))
+
+    def cpu_line(self, cpu_stats):
+        contended = cpu_stats.is_contended()
+        print(StatsTerminalPrinter.colored("{} ".format(cpu_stats.label), BColors.BOLD), end='')
+        print(StatsTerminalPrinter.colored(CPUHeatmap.bar(cpu_stats.total_cpu), self.cpu_color(cpu_stats.total_cpu)),
+              end='')
+        print(StatsTerminalPrinter.colored(" {:6.2f}%".format(cpu_stats.total_cpu),
+                                           self.cpu_color(cpu_stats.total_cpu)), end='')
+        print(" | threads: {} (hot: ".format(cpu_stats.threads), end='')
+        if contended:
+            print(StatsTerminalPrinter.colored("{}".format(cpu_stats.hot_threads), BColors.FAIL), end='')
+        else:
+            print("{}".format(cpu_stats.hot_threads), end='')
+        print(") | max run-queue latency: ", end='')
+        print(StatsTerminalPrinter.colored(self.nanos_fmt(cpu_stats.max_run_queue_latency),
+                                           self.latency_color(cpu_stats.max_run_queue_latency)), end='')
+        if cpu_stats.hottest_thread is not None:
+            print(" | hottest: tid {} \"{}\" {:3.2f}%"
+                  .format(cpu_stats.hottest_thread.tid, cpu_stats.hottest_thread.name,
+                          cpu_stats.hottest_thread.thread_stats.cpu.total_cpu), end='')
+        if contended:
+            print(StatsTerminalPrinter.colored(" << contention", BColors.FAIL), end='')
+        print('')
+
     def next_line(self, thread_info):
         print(
             StatsTerminalPrinter.colored(
@@ -771,7 +2227,23 @@ class StatsTerminalPrinter:
             self.latency_color(thread_info.thread_stats.scheduler_stats.delta_run_queue_latency)), end='')
         print(", # of timeslices run in current CPU: ", end='')
         print("{}".format(thread_info.thread_stats.scheduler_stats.delta_timeslices_on_current_cpu), end='')
-        print("]")
+        if thread_info.thread_stats.scheduler_stats.delta_throttled_time > 0:
+            print(", est. throttled: ", end='')
+            print(StatsTerminalPrinter.colored(
+                self.nanos_fmt(thread_info.thread_stats.scheduler_stats.delta_throttled_time), BColors.FAIL), end='')
+        print("]", end='')
+        state = thread_info.thread_stats.state
+        if state.samples > 0:
+            print(" [state R: ", end='')
+            print(StatsTerminalPrinter.colored("{:3.1f}%".format(state.running), self.cpu_color(state.running)),
+                  end='')
+            print(", S: {:3.1f}%, D: ".format(state.sleeping), end='')
+            print(StatsTerminalPrinter.colored("{:3.1f}%".format(state.disk_sleep), self.cpu_color(state.disk_sleep)),
+                  end='')
+            if state.wchan:
+                print(" (wchan: {})".format(state.wchan), end='')
+            print(", other: {:3.1f}%]".format(state.other), end='')
+        print("")
 
         print("I/O disk [kB_rd/s: ", end='')
         print(StatsTerminalPrinter.colored("{}".format(thread_info.thread_stats.disk.kb_rd_per_sec),
@@ -781,6 +2253,17 @@ class StatsTerminalPrinter:
                                            self.io_color(thread_info.thread_stats.disk.kb_wr_per_sec)), end='')
         print("]")
 
+        switches = thread_info.thread_stats.switches
+        print("Context switches [voluntary: ", end='')
+        print("{}".format(switches.delta_voluntary_switches), end='')
+        print(", involuntary: ", end='')
+        print(StatsTerminalPrinter.colored("{}".format(switches.delta_involuntary_switches),
+                                           self.switch_color(switches.delta_involuntary_switches)), end='')
+        print(", CPU migrations: ", end='')
+        print(StatsTerminalPrinter.colored("{}".format(switches.delta_migrations),
+                                           self.switch_color(switches.delta_migrations)), end='')
+        print("]")
+
         for line in thread_info.dump.split(os.linesep):
             print(line)
 
@@ -818,6 +2301,15 @@ class StatsTerminalPrinter:
         else:
             return BColors.FAIL
 
+    @staticmethod
+    def switch_color(value):
+        if value < 100:
+            return BColors.OKGREEN
+        elif value < 1000:
+            return BColors.WARNING
+        else:
+            return BColors.FAIL
+
     @staticmethod
     def sizeof_fmt(num, suffix='B'):
         for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']: